@@ -1,12 +1,14 @@
 from google import genai
 from google.genai import types
+# 所有 Agent 共用一个客户端，复用 HTTP 连接（fork 出的子进程需自行创建）
+_CLIENT = genai.Client()
 class Agent:
     def __init__(self, model: str):
         self.model = model
-        self.client = genai.Client()
+        self.client = _CLIENT
         self.contents = []
     def run(self, contents: str):
-        self.contents.append({"role": "user", "parts": [{"text": contents}]})
+        self.contents.append(types.Content(role="user", parts=[types.Part.from_text(text=contents)]))
         response = self.client.models.generate_content(model=self.model, contents=self.contents)
         self.contents.append(response.candidates[0].content)
         return response
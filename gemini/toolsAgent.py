@@ -32,9 +32,38 @@ Gemini Function Calling (工具调用) 完整示例
 """
 
 import os
-import json
-from google import genai
-from google.genai import types
+import logging
+import time
+import itertools
+import asyncio
+import hashlib
+import inspect
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+import orjson
+
+# google.genai 会连带导入 pydantic、httpx 等大量模块，导入就要花不少时间。
+# 这里推迟到第一次创建客户端或 Agent 时才导入（见 _import_genai），
+# 之后在模块内照常使用 genai / types / errors 这三个名字。
+genai = None
+types = None
+errors = None
+
+
+def _import_genai():
+    """第一次调用时导入 google.genai，之后直接返回"""
+    global genai, types, errors
+    if genai is None:
+        from google import genai as _genai
+        from google.genai import errors as _errors, types as _types
+        genai, types, errors = _genai, _types, _errors
+
+# 运行过程日志：用环境变量 AGENT_LOG_LEVEL 控制详细程度
+#   WARNING - 安静模式，只显示警告
+#   INFO    - 显示每一步的执行过程（默认）
+#   DEBUG   - 额外显示工具执行结果和完整对话历史
+# 日志参数使用 %r / %s 占位符，级别不够时不会把大结果（如长文件列表）转换成字符串
+logger = logging.getLogger(__name__)
 
 # ==============================================================================
 # 第一部分：定义工具（Tool Definitions）
@@ -44,13 +73,14 @@ from google.genai import types
 # - 工具的功能描述
 # - 需要哪些参数
 #
-# 重要：必须使用 types.FunctionDeclaration 格式，不能用普通字典！
+# 定义写成与 types.FunctionDeclaration 字段相同的普通字典，
+# 创建 Agent 时 SDK 会把它们转换成 types.FunctionDeclaration（这样导入本文件时不需要导入 SDK）
 
 # 工具1：读取文件
-read_file_definition = types.FunctionDeclaration(
-    name="read_file",  # 工具名称
-    description="读取文件并返回其内容。",  # 描述告诉模型这个工具做什么
-    parameters={  # 参数定义
+read_file_definition = {
+    "name": "read_file",  # 工具名称
+    "description": "读取文件并返回其内容。",  # 描述告诉模型这个工具做什么
+    "parameters": {  # 参数定义
         "type": "object",
         "properties": {
             "file_path": {
@@ -60,13 +90,13 @@ read_file_definition = types.FunctionDeclaration(
         },
         "required": ["file_path"],  # 必需参数
     },
-)
+}
 
 # 工具2：列出目录内容
-list_dir_definition = types.FunctionDeclaration(
-    name="list_dir",
-    description="列出指定目录中的所有文件和文件夹。使用 '.' 表示当前目录。",
-    parameters={
+list_dir_definition = {
+    "name": "list_dir",
+    "description": "列出指定目录中的所有文件和文件夹。使用 '.' 表示当前目录。",
+    "parameters": {
         "type": "object",
         "properties": {
             "directory_path": {
@@ -76,13 +106,13 @@ list_dir_definition = types.FunctionDeclaration(
         },
         "required": ["directory_path"],
     },
-)
+}
 
 # 工具3：写入文件
-write_file_definition = types.FunctionDeclaration(
-    name="write_file",
-    description="使用给定内容写入文件。",
-    parameters={
+write_file_definition = {
+    "name": "write_file",
+    "description": "使用给定内容写入文件。",
+    "parameters": {
         "type": "object",
         "properties": {
             "file_path": {
@@ -96,28 +126,45 @@ write_file_definition = types.FunctionDeclaration(
         },
         "required": ["file_path", "contents"],
     },
-)
+}
 
 # ==============================================================================
 # 第二部分：实现工具的实际功能（Tool Implementations）
 # ==============================================================================
 # 这些是真正执行操作的 Python 函数，在本地运行，不访问大模型
+#
+# 工具结果会整个发送给模型，所以这里限制结果大小：
+# 超大文件或超大目录既占内存，也会撑爆模型的输入 token 上限
+
+READ_FILE_MAX_BYTES = 256 * 1024  # read_file 最多读取的字节数
+LIST_DIR_MAX_ENTRIES = 1000  # list_dir 最多返回的条目数
+TRUNCATED_MARKER = "...[truncated]"  # 结果被截断时追加的标记
 
 def read_file(file_path: str) -> str:
-    """读取文件内容"""
-    with open(file_path, "r") as f:
-        return f.read()
+    """读取文件内容（超过 READ_FILE_MAX_BYTES 的部分被截断）"""
+    with open(file_path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        data = f.read(READ_FILE_MAX_BYTES)
+    text = data.decode("utf-8", errors="replace")
+    if size > READ_FILE_MAX_BYTES:
+        text += TRUNCATED_MARKER
+    return text
 
 def write_file(file_path: str, contents: str) -> bool:
     """写入文件内容"""
-    with open(file_path, "w") as f:
+    with open(file_path, "w", encoding="utf-8", buffering=1 << 20) as f:
         f.write(contents)
     return True
 
 def list_dir(directory_path: str) -> list[str]:
-    """列出目录中的所有文件和文件夹"""
+    """列出目录中的文件和文件夹（最多 LIST_DIR_MAX_ENTRIES 个）"""
     full_path = os.path.expanduser(directory_path)  # 展开 ~ 等路径符号
-    return os.listdir(full_path)  # 返回文件列表
+    # os.scandir 是惰性迭代器，超大目录也只读取需要的条目
+    with os.scandir(full_path) as entries:
+        names = [entry.name for entry in itertools.islice(entries, LIST_DIR_MAX_ENTRIES + 1)]
+    if len(names) > LIST_DIR_MAX_ENTRIES:
+        names[LIST_DIR_MAX_ENTRIES:] = [TRUNCATED_MARKER]
+    return names  # 返回文件列表
 
 # ==============================================================================
 # 第三部分：组装工具字典
@@ -140,8 +187,204 @@ file_tools = {
     },
 }
 
+# 模型给出的参数可以安全转换的类型（bool("false") 为 True，所以不转换 bool）
+_COERCIBLE_TYPES = (str, int, float)
+
+
+def _make_adapter(function):
+    """
+    为工具函数生成调用适配器
+
+    用 inspect 解析一次函数签名，之后每次调用：
+    1. 校验模型给出的参数（缺少必需参数、多出未知参数）
+    2. 按类型注解转换参数类型（如把 "3" 转成 3）
+    3. 按关键字调用函数（仅限位置参数按位置传入）
+    参数不合法时返回 {"error": ...} 交给模型处理，而不是让程序崩溃
+
+    *args 无法从参数字典得到，直接忽略；有 **kwargs 时允许额外的参数，原样传入
+    """
+    params = []
+    accepts_extra = False
+    for name, param in inspect.signature(function).parameters.items():
+        if param.kind is inspect.Parameter.VAR_KEYWORD:
+            accepts_extra = True
+            continue
+        if param.kind is inspect.Parameter.VAR_POSITIONAL:
+            continue
+        params.append((
+            name,
+            param.annotation if param.annotation in _COERCIBLE_TYPES else None,
+            param.default is inspect.Parameter.empty,
+            param.kind is inspect.Parameter.POSITIONAL_ONLY,
+        ))
+    names = {name for name, _, _, _ in params}
+
+    def adapter(args):
+        args = args or {}
+        unknown = set(args) - names
+        if unknown and not accepts_extra:
+            return {"error": f"未知参数: {', '.join(sorted(unknown))}"}
+
+        positional = []
+        bound = {name: args[name] for name in unknown}
+        for name, kind, required, positional_only in params:
+            if name not in args:
+                if required:
+                    return {"error": f"缺少必需参数: {name}"}
+                continue
+            value = args[name]
+            if kind is not None and not isinstance(value, kind):
+                try:
+                    value = kind(value)
+                except (TypeError, ValueError):
+                    return {"error": f"参数 {name} 应为 {kind.__name__} 类型"}
+            if positional_only:
+                positional.append(value)
+            else:
+                bound[name] = value
+        return function(*positional, **bound)
+
+    return adapter
+
+# ==============================================================================
+# 第四部分：共享客户端（Shared Client）
+# ==============================================================================
+# 每个 genai.Client 都有自己的 HTTP 连接池。如果每个 Agent 都新建客户端，
+# 每次 generate_content 都要重新做 TCP + TLS 握手（约 100~300 ms）。
+# 这里整个进程共用一个客户端，所有 Agent、所有请求都复用同一个连接池。
+#
+# 注意：连接池不能跨进程共享。如果用 multiprocessing / fork 启动子进程，
+# 子进程必须自己创建客户端，不要使用父进程里的 _CLIENT。
+
+_CLIENT = None  # 进程内共享的客户端，第一次使用时创建
+
+# 连接池上限：httpx 默认只保留 20 个 keep-alive 连接，并发请求多时会反复握手
+_HTTP_LIMITS = {"max_connections": 100, "max_keepalive_connections": 100}
+
+
+def get_client() -> "genai.Client":
+    """返回进程内共享的 Gemini 客户端（需要设置 API key）"""
+    global _CLIENT
+    if _CLIENT is None:
+        _import_genai()
+        import httpx
+
+        # 旧版本 SDK 的 HttpOptions 没有 client_args / async_client_args，此时使用默认连接池
+        http_args = {}
+        if "client_args" in types.HttpOptions.model_fields:
+            http_args["client_args"] = {"limits": httpx.Limits(**_HTTP_LIMITS)}
+        # client.aio（AsyncAgent）使用 async_client_args 创建异步 httpx 客户端；
+        # 安装了 aiohttp 时 SDK 改用 aiohttp（连接数不限），这些参数会传给 aiohttp，不能设置
+        if ("async_client_args" in types.HttpOptions.model_fields
+                and importlib.util.find_spec("aiohttp") is None):
+            http_args["async_client_args"] = {"limits": httpx.Limits(**_HTTP_LIMITS)}
+        http_options = types.HttpOptions(**http_args) if http_args else None
+        _CLIENT = genai.Client(http_options=http_options)
+    return _CLIENT
+
+# 显式缓存到期前多少秒开始续期（避免一轮对话进行到一半时缓存过期）
+_CACHE_REFRESH_MARGIN = 60
+
+# 本地响应缓存：{请求哈希: (过期时间, 响应)}
+# 进程内所有 Agent 共用（缓存键已包含模型、配置和对话历史），
+# 新建的 Agent（比如评测循环里每道题一个 Agent）也能命中之前的结果
+_RESPONSE_CACHE = {}
+_RESPONSE_CACHE_SIZE = 256  # 最多保存的条数
+
+# 语义缓存：用向量表示用户问题，意思相近的问题直接复用之前的回答
+_EMBEDDING_MODEL = "gemini-embedding-001"  # 向量模型
+_EMBEDDING_DIM = 768  # 向量维度，维度越低本地相似度计算越快
+_SEMANTIC_CACHE_SIZE = 1000  # 最多保存的条数
+_SEMANTIC_CONTEXT_WINDOW = 4  # 多轮对话时，结合最近几轮用户问题（含本轮）
+_SEMANTIC_QUERY_WEIGHT = 0.70  # 本轮问题的权重，其余权重平均分给之前的问题
+
+
+def _normalize(vector: list[float]) -> list[float]:
+    """归一化向量，之后余弦相似度就等于点积"""
+    norm = sum(x * x for x in vector) ** 0.5
+    return [x / norm for x in vector] if norm else list(vector)
+
+
+def _describe_part(part) -> str:
+    """把一个 part 转换成便于阅读的文本"""
+    if part.text:
+        return part.text
+    if part.function_call:
+        return f"函数调用 {part.function_call.name}({part.function_call.args})"
+    if part.function_response:
+        return f"函数响应 {part.function_response.name}: {part.function_response.response}"
+    return ""
+
+
+def _serialize(content) -> bytes:
+    """把一条消息序列化成 JSON 字节串（键排序，保证相同内容得到相同结果）"""
+    return orjson.dumps(
+        content.model_dump(mode="json", exclude_none=True),
+        option=orjson.OPT_SORT_KEYS, default=str,
+    )
+
+
+def _chunk_parts(chunk) -> list:
+    """取出流式响应中一个片段的所有 part"""
+    if not chunk.candidates or chunk.candidates[0].content is None:
+        return []
+    return chunk.candidates[0].content.parts or []
+
+
+def _is_plain_text(part) -> bool:
+    """是否是可以合并的普通文本 part（不是思考内容，也不带思考签名）"""
+    # 旧版本 SDK 的 Part 没有 thought_signature 字段
+    return (part.text is not None and not part.thought
+            and not getattr(part, "thought_signature", None))
+
+
+def _merge_text_parts(parts: list) -> list:
+    """把流式片段中连续的普通文本 part 合并成一个，函数调用等其他 part 原样保留"""
+    merged = []
+    for part in parts:
+        if _is_plain_text(part) and merged and _is_plain_text(merged[-1]):
+            merged[-1] = types.Part(text=merged[-1].text + part.text)
+        else:
+            merged.append(part)
+    return merged
+
+
+def _ttl_seconds(ttl: str) -> float:
+    """把 "3600s" 这样的有效期字符串转换成秒数"""
+    return float(ttl.rstrip("s"))
+
+
+def _response_from_content(content):
+    """把拼好的完整消息包装成响应对象，和非流式调用的返回值保持一致"""
+    return types.GenerateContentResponse(candidates=[types.Candidate(content=content)])
+
+
+def _is_user_text(content) -> bool:
+    """是否是一条用户文本消息（即一轮对话的开始，而不是函数响应）"""
+    return content.role == "user" and any(p.text for p in content.parts or ())
+
+
+# 对话历史压缩：超过 max_tokens 后，用便宜的模型把较早的轮次总结成一条消息
+_SUMMARY_MODEL = "gemini-2.5-flash-lite"  # 用于总结的模型
+_KEEP_TURNS = 4  # 压缩时至少保留最近几轮完整对话
+# 压缩后的目标长度（max_tokens 的比例）：压到上限以下留出余量，
+# 之后要再积累若干轮才会再次压缩，而不是每轮都多一次总结调用
+_COMPACT_TARGET_RATIO = 0.5
+
+# 批量接口不可用时，退路最多同时发送的请求数
+_MAX_CONCURRENT_REQUESTS = 16
+
+# 批量任务结束时的状态（成功、部分成功、失败、取消、过期）
+_BATCH_DONE_STATES = {
+    "JOB_STATE_SUCCEEDED",
+    "JOB_STATE_PARTIALLY_SUCCEEDED",
+    "JOB_STATE_FAILED",
+    "JOB_STATE_CANCELLED",
+    "JOB_STATE_EXPIRED",
+}
+
 # ==============================================================================
-# 第四部分：Agent 类 - 封装工具调用逻辑
+# 第五部分：Agent 类 - 封装工具调用逻辑
 # ==============================================================================
 
 class Agent:
@@ -152,7 +395,9 @@ class Agent:
     3. 维护对话历史
     """
 
-    def __init__(self, model: str, tools: dict, system_instruction: str = None):
+    def __init__(self, model: str, tools: dict, system_instruction: str = None,
+                 cache_ttl: str = None, response_cache_ttl: float = None,
+                 semantic_cache_threshold: float = None, max_tokens: int = None):
         """
         初始化代理
 
@@ -160,12 +405,417 @@ class Agent:
             model: 模型名称，如 "gemini-2.5-flash"
             tools: 工具字典，包含工具定义和实现函数
             system_instruction: 系统指令（可选），设置模型的行为方式
+            cache_ttl: 显式缓存的有效期（可选），如 "3600s"。设置后会把系统指令和
+                       工具声明上传为 Gemini 缓存，之后每轮只需引用缓存名称
+            response_cache_ttl: 本地响应缓存的有效期（秒，可选）。设置后，模型、对话历史
+                                和配置完全相同的请求直接返回缓存的响应，不再调用 API
+                                （缓存由所有 Agent 共用）
+            semantic_cache_threshold: 语义缓存的相似度阈值（可选），如 0.85。设置后，
+                                      与之前的问题相似度达到阈值时直接返回之前的回答
+            max_tokens: 对话历史的长度上限（可选，按序列化后的字节数近似估算 token）。超过后把
+                        较早的轮次总结成一条消息，压缩到上限的一半左右，
+                        并至少保留最近几轮完整对话
         """
+        _import_genai()  # 第一次创建 Agent 时才导入 SDK
         self.model = model  # 保存模型名称
-        self.client = genai.Client()  # 创建 Gemini 客户端（需要设置 API key）
+        self.client = get_client()  # 复用共享的 Gemini 客户端（连接池）
         self.contents = []  # 对话历史列表，记录所有轮次
+        # 每条消息在加入历史时序列化一次，计算缓存键和历史长度时不再重复序列化整段历史
+        self._committed = []  # 与 self.contents 一一对应的 JSON 字节串
+        self._committed_size = 0  # 已提交消息的总字节数
+        self._history_hash = hashlib.blake2b()  # 已提交消息的累积哈希
         self.tools = tools  # 保存工具字典
         self.system_instruction = system_instruction  # 保存系统指令
+        self.cache_ttl = cache_ttl  # 显式缓存有效期
+        self.response_cache_ttl = response_cache_ttl  # 本地响应缓存有效期
+        self.semantic_cache_threshold = semantic_cache_threshold  # 语义缓存阈值
+        self._semantic_cache = []  # 语义缓存：[(问题向量, 响应)]
+        self._recent_embeddings = []  # 最近几轮用户问题的向量
+        self.max_tokens = max_tokens  # 对话历史长度上限
+
+        # 按工具名称排序，工具声明的顺序不再依赖 file_tools 的书写顺序，
+        # 序列化后的前缀在重启和改代码后保持一致，提示词缓存才能稳定命中
+        self._sorted_tools = sorted(tools.items(), key=lambda kv: kv[0])
+
+        # 工具列表和系统指令在多轮对话中不会变化，只在初始化时构建一次
+        self._tool_list = [
+            types.Tool(
+                function_declarations=[
+                    tool["definition"] for _, tool in self._sorted_tools
+                ]
+            )
+        ]
+
+        # 显式缓存对象及其过期时间（time.monotonic），没有使用显式缓存时为 None。
+        # 缓存在第一轮对话开始时才创建（见 _refresh_cache），创建 Agent 不会发出网络请求
+        self._cache = None
+        self._cache_expires_at = None
+        self._cache_pending = bool(cache_ttl)  # 设置了 cache_ttl 但还没创建缓存
+        self._set_cache(None)
+
+        # 工具名称 → 调用适配器，参数解析在这里一次完成，执行工具时直接调用
+        self._adapters = {name: _make_adapter(tool["function"]) for name, tool in tools.items()}
+
+    def _build_config(self):
+        """
+        配置工具列表和系统指令
+
+        告诉模型有哪些工具可用，以及如何表现（system_instruction）
+
+        提示词缓存（prompt caching）按"字节完全相同的前缀"命中，所以请求的布局是：
+            [系统指令] → [工具声明] → [已提交的对话历史] → [本轮新消息]
+        前两部分只在这里构建一次，对话历史只追加不修改，
+        这样每一轮只有末尾的新消息需要重新计算。
+        """
+        if self._cache is not None:
+            # 使用缓存时，系统指令和工具已经在缓存里，不能再重复传入
+            return types.GenerateContentConfig(cached_content=self._cache.name)
+
+        config_params = {"tools": self._tool_list}
+
+        # 如果设置了系统指令，添加到配置中
+        if self.system_instruction:
+            config_params["system_instruction"] = self.system_instruction
+
+        return types.GenerateContentConfig(**config_params)
+
+    def _set_cache(self, cache):
+        """切换显式缓存（None 表示不使用），并重新构建配置"""
+        self._cache = cache
+        if cache is not None:
+            self._cache_expires_at = time.monotonic() + _ttl_seconds(self.cache_ttl)
+        self._config = self._build_config()
+        # 配置在两次切换之间不变，序列化结果也只需计算一次，用于响应缓存的键
+        self._config_key = self._config.model_dump_json(exclude_none=True)
+
+    def _cache_config(self):
+        """上传为显式缓存的内容：系统指令和工具声明（不变的前缀）"""
+        return types.CreateCachedContentConfig(
+            system_instruction=self.system_instruction,
+            tools=self._tool_list,
+            ttl=self.cache_ttl,
+        )
+
+    def _create_cache(self):
+        """把不变的前缀上传为显式缓存，失败时返回 None"""
+        try:
+            return self.client.caches.create(model=self.model, config=self._cache_config())
+        except errors.APIError as e:
+            # 常见原因：前缀太短，达不到显式缓存的最小 token 数
+            # 此时退回普通配置（gemini-2.5 系列仍会对稳定前缀做隐式缓存）
+            logger.warning(">>> 创建缓存失败，改用普通配置: %s", e)
+            return None
+
+    def _refresh_cache(self):
+        """
+        每轮对话开始前调用：第一次调用时创建显式缓存，之后在缓存快过期时延长有效期
+
+        缓存已经失效（过期、被删除）导致续期失败时，重新创建缓存并更新配置
+        """
+        if self._cache_pending:
+            self._cache_pending = False
+            self._set_cache(self._create_cache())
+            return
+        if self._cache is None:
+            return
+        if time.monotonic() < self._cache_expires_at - _CACHE_REFRESH_MARGIN:
+            return
+        try:
+            self._cache = self.client.caches.update(
+                name=self._cache.name,
+                config=types.UpdateCachedContentConfig(ttl=self.cache_ttl),
+            )
+            self._cache_expires_at = time.monotonic() + _ttl_seconds(self.cache_ttl)
+        except errors.APIError as e:
+            logger.warning(">>> 缓存续期失败，重新创建缓存: %s", e)
+            self._set_cache(None)
+            self._set_cache(self._create_cache())
+
+    def close(self):
+        """
+        删除显式缓存（如果有）
+
+        Agent 用完后调用，否则缓存会一直保留在服务器上直到过期（期间按存储时长计费）。
+        调用后不要再使用这个 Agent。
+        """
+        self._cache_pending = False
+        if self._cache is None:
+            return
+        try:
+            self.client.caches.delete(name=self._cache.name)
+        except errors.APIError as e:
+            logger.warning(">>> 删除缓存失败: %s", e)
+        self._cache = None
+
+    def _append(self, content):
+        """追加一条消息到对话历史，同时记录它的序列化结果"""
+        self.contents.append(content)
+        self._commit(content)
+
+    def _commit(self, content):
+        """序列化一条消息，更新累积的长度和哈希"""
+        data = _serialize(content)
+        self._committed.append(data)
+        self._committed_size += len(data)
+        self._history_hash.update(len(data).to_bytes(8, "little"))
+        self._history_hash.update(data)
+
+    def _recommit(self):
+        """对话历史被整体替换（压缩、外部修改）后，重新计算序列化结果"""
+        self._committed = []
+        self._committed_size = 0
+        self._history_hash = hashlib.blake2b()
+        for content in self.contents:
+            self._commit(content)
+
+    def _sync_committed(self):
+        """self.contents 被外部直接修改过（如 clear()）时，重新计算序列化结果"""
+        if len(self._committed) != len(self.contents):
+            self._recommit()
+
+    def _cache_key(self) -> str:
+        """用 对话历史 + 模型 + 配置 计算响应缓存的键（历史部分是累积哈希，无需重新遍历）"""
+        self._sync_committed()
+        key = self._history_hash.copy()
+        key.update(self.model.encode())
+        key.update(self._config_key.encode())
+        return key.hexdigest()
+
+    def _cache_get(self, key: str):
+        """查找未过期的缓存响应，没有则返回 None"""
+        entry = _RESPONSE_CACHE.get(key)
+        if entry is None:
+            return None
+        expires_at, response = entry
+        if time.monotonic() > expires_at:
+            del _RESPONSE_CACHE[key]
+            return None
+        return response
+
+    def _cache_put(self, key: str, response):
+        """缓存响应；没有候选结果的响应（被拦截、出错等）不缓存"""
+        if not response.candidates or response.candidates[0].content is None:
+            return
+        if len(_RESPONSE_CACHE) >= _RESPONSE_CACHE_SIZE:
+            # 淘汰最早放入的一条
+            _RESPONSE_CACHE.pop(next(iter(_RESPONSE_CACHE)))
+        _RESPONSE_CACHE[key] = (time.monotonic() + self.response_cache_ttl, response)
+
+    def _generate(self):
+        """调用大模型；开启了响应缓存时，完全相同的请求直接返回缓存结果"""
+        if not self.response_cache_ttl:
+            return self.client.models.generate_content(
+                model=self.model,
+                contents=self.contents,
+                config=self._config
+            )
+
+        key = self._cache_key()
+        response = self._cache_get(key)
+        if response is not None:
+            logger.info(">>> 命中响应缓存，跳过 API 调用")
+            return response
+        response = self.client.models.generate_content(
+            model=self.model,
+            contents=self.contents,
+            config=self._config
+        )
+        self._cache_put(key, response)
+        return response
+
+    def _embed(self, text: str) -> list[float]:
+        """调用向量模型，把用户问题转换成向量"""
+        result = self.client.models.embed_content(
+            model=_EMBEDDING_MODEL,
+            contents=text,
+            config=types.EmbedContentConfig(
+                task_type="SEMANTIC_SIMILARITY",
+                output_dimensionality=_EMBEDDING_DIM,
+            ),
+        )
+        return result.embeddings[0].values
+
+    def _query_embedding(self, values: list[float]) -> list[float]:
+        """
+        计算用于查询语义缓存的向量
+
+        多轮对话中"告诉我更多"这类问题本身没有意义，
+        所以把本轮问题和之前几轮问题的向量按权重混合后再查询
+        """
+        vector = _normalize(values)
+        history = self._recent_embeddings[-(_SEMANTIC_CONTEXT_WINDOW - 1):]
+        self._recent_embeddings = history + [vector]
+        if not history:
+            return vector
+
+        context = [sum(column) / len(history) for column in zip(*history)]
+        return _normalize([
+            _SEMANTIC_QUERY_WEIGHT * q + (1 - _SEMANTIC_QUERY_WEIGHT) * c
+            for q, c in zip(vector, context)
+        ])
+
+    def _semantic_lookup(self, embedding: list[float]):
+        """查找相似度最高且达到阈值的缓存响应，没有则返回 None"""
+        best, best_score = None, self.semantic_cache_threshold
+        for vector, response in self._semantic_cache:
+            score = sum(a * b for a, b in zip(embedding, vector))
+            if score >= best_score:
+                best, best_score = response, score
+        if best is not None:
+            logger.info(">>> 命中语义缓存（相似度 %.2f），跳过 API 调用", best_score)
+        return best
+
+    def _semantic_store(self, embedding: list[float], response):
+        """把本轮的最终回答放入语义缓存（只用于没有调用工具的轮次）"""
+        if not response.candidates or response.candidates[0].content is None:
+            return
+        if len(self._semantic_cache) >= _SEMANTIC_CACHE_SIZE:
+            self._semantic_cache.pop(0)
+        self._semantic_cache.append((embedding, response))
+
+    def _history_size(self) -> int:
+        """对话历史的近似 token 数（按序列化后的字节数估算）"""
+        self._sync_committed()
+        return self._committed_size
+
+    def _compaction_cut(self):
+        """
+        计算需要压缩的历史范围，返回切分位置；不需要压缩时返回 None
+
+        只在用户消息处切分，保证函数调用和函数响应不会被拆开
+        """
+        if not self.max_tokens or self._history_size() <= self.max_tokens:
+            return None
+        turn_starts = [i for i, c in enumerate(self.contents) if _is_user_text(c)]
+        if len(turn_starts) <= _KEEP_TURNS:
+            return None
+        # 从较早的轮次开始找：保留尽量多的完整轮次，同时让剩余部分降到目标长度以内
+        target = int(self.max_tokens * _COMPACT_TARGET_RATIO)
+        tail_size = self._committed_size
+        start = 0
+        for cut in turn_starts[1:len(turn_starts) - _KEEP_TURNS + 1]:
+            tail_size -= sum(len(data) for data in self._committed[start:cut])
+            start = cut
+            if tail_size <= target:
+                return cut
+        # 只保留最近几轮也超过目标长度时，压缩无法留出余量，跳过（否则每轮都要压缩）
+        return None
+
+    def _summary_request(self, cut: int) -> str:
+        """把需要压缩的轮次整理成纯文本，交给模型总结"""
+        lines = []
+        for content in self.contents[:cut]:
+            for part in content.parts or ():
+                lines.append(f"{content.role or 'model'}: {_describe_part(part)}")
+        return (
+            "用简洁的几句话总结下面这段对话的要点，保留文件名、结论等关键信息：\n\n"
+            + "\n".join(lines)
+        )
+
+    def _apply_summary(self, cut: int, summary: str):
+        """用一条总结消息替换较早的轮次（系统指令和工具声明在配置里，不受影响）"""
+        if not summary:
+            # 模型没有返回文本（如被安全过滤），保留原历史，下一轮再试
+            logger.warning(">>> 总结为空，跳过本次压缩")
+            return
+        logger.info(">>> 对话历史过长，已将前 %d 条消息压缩为总结", cut)
+        self.contents[:cut] = [
+            types.Content(role="user", parts=[types.Part.from_text(text=f"[summary]: {summary}")])
+        ]
+        self._recommit()
+
+    def _compact(self):
+        """每轮结束后检查对话历史长度，必要时压缩"""
+        cut = self._compaction_cut()
+        if cut is None:
+            return
+        try:
+            response = self.client.models.generate_content(
+                model=_SUMMARY_MODEL,
+                contents=self._summary_request(cut)
+            )
+        except errors.APIError as e:
+            # 本轮回答已经得到，压缩失败（如 429）不应影响返回结果
+            logger.warning(">>> 压缩对话历史失败，跳过: %s", e)
+            return
+        self._apply_summary(cut, response.text)
+
+    def _function_calls(self, response) -> list:
+        """
+        检查模型是否决定调用工具，返回所有函数调用（可能有多个）
+
+        没有函数调用时返回空列表
+        """
+        # Part 对象一定有 function_call 属性（没有调用时为 None），遍历一遍即可
+        parts = response.candidates[0].content.parts or ()
+        return [part.function_call for part in parts if part.function_call is not None]
+
+    def _log_calls(self, function_calls: list):
+        """打印每个函数调用"""
+        for function_call in function_calls:
+            # 工具名称，如 "list_dir"；参数，如 {"directory_path": "."}
+            logger.info(">>> 在本地执行工具: %s(%r)", function_call.name, function_call.args)
+
+    def _run_tool(self, function_call):
+        """调用实际的 Python 函数（本地执行）"""
+        # 适配器把参数字典按位置传给函数
+        # 例如：list_dir 的适配器收到 {"directory_path": "."}
+        #    等价于：list_dir(".")
+        adapter = self._adapters.get(function_call.name)
+        if adapter is None:
+            # 和参数不合法一样返回错误，保证每个函数调用都有对应的函数响应
+            return {"error": f"未知工具: {function_call.name}"}
+        try:
+            return adapter(function_call.args)
+        except Exception as e:
+            # 工具抛出异常（如文件不存在）时同样返回结果，交给模型处理；
+            # 否则对话历史里会留下没有函数响应的函数调用
+            return {"error": repr(e)}
+
+    def _function_response(self, function_name: str, result):
+        """把函数执行结果包装成对话历史中的一条消息（轮次3）"""
+        return types.Content(
+            role="user",  # 角色：用户（函数结果以用户身份发送）
+            parts=[types.Part.from_function_response(
+                name=function_name,
+                response={"result": result}
+            )]
+        )
+
+    def _execute_tools(self, function_calls: list):
+        """执行所有函数调用，并按调用顺序把结果添加到对话历史（轮次3）"""
+        # 模型一次可能返回多个互不依赖的调用（比如同时读两个文件），
+        # 这里用线程池并发执行，总耗时约等于最慢的那个工具
+        self._log_calls(function_calls)
+        if len(function_calls) > 1:
+            with ThreadPoolExecutor(max_workers=len(function_calls)) as executor:
+                results = list(executor.map(self._run_tool, function_calls))
+        else:
+            results = [self._run_tool(fc) for fc in function_calls]
+
+        # 按调用顺序添加，保证结果和调用一一对应
+        for function_call, result in zip(function_calls, results):
+            logger.debug(">>> 工具执行结果: %r", result)
+            self._append(self._function_response(function_call.name, result))
+
+    def _stream_generate(self):
+        """
+        流式调用大模型：边接收边 yield 文本片段
+
+        结束后通过 return 返回拼好的完整消息（调用方用 yield from 取得），
+        其中的函数调用会原样保留
+        """
+        parts = []
+        for chunk in self.client.models.generate_content_stream(
+            model=self.model,
+            contents=self.contents,
+            config=self._config
+        ):
+            for part in _chunk_parts(chunk):
+                if part.text and not part.thought:
+                    yield part.text
+                parts.append(part)
+        return types.Content(role="model", parts=_merge_text_parts(parts))
 
     def run(self, contents: str):
         """
@@ -187,33 +837,28 @@ class Agent:
             4. 返回最终响应
         """
 
+        self._refresh_cache()  # 第一轮时创建显式缓存，之后在快过期时续期
+
         # ------------------------------------------------------------------
         # 步骤1：添加用户消息到对话历史（轮次1）
         # ------------------------------------------------------------------
-        self.contents.append({
-            "role": "user",  # 角色：用户
-            "parts": [{"text": contents}]  # 消息内容
-        })
+        self._append(types.Content(
+            role="user",  # 角色：用户
+            parts=[types.Part.from_text(text=contents)]  # 消息内容
+        ))
 
         # ------------------------------------------------------------------
-        # 步骤2：配置工具列表和系统指令
+        # 步骤2：查询语义缓存（工具列表和系统指令已在 __init__ 中构建好）
         # ------------------------------------------------------------------
-        # 告诉模型有哪些工具可用，以及如何表现（system_instruction）
-        config_params = {
-            "tools": [
-                types.Tool(
-                    function_declarations=[
-                        tool["definition"] for tool in self.tools.values()
-                    ]
-                )
-            ]
-        }
-
-        # 如果设置了系统指令，添加到配置中
-        if self.system_instruction:
-            config_params["system_instruction"] = self.system_instruction
-
-        config = types.GenerateContentConfig(**config_params)
+        # 意思相近的问题（如"列出目录"和"这个目录里有哪些文件"）直接返回之前的回答
+        query_embedding = None
+        if self.semantic_cache_threshold:
+            query_embedding = self._query_embedding(self._embed(contents))
+            cached = self._semantic_lookup(query_embedding)
+            if cached is not None:
+                self._append(cached.candidates[0].content)
+                self._compact()
+                return cached
 
         # ------------------------------------------------------------------
         # 步骤3：【第1次调用大模型】
@@ -221,65 +866,24 @@ class Agent:
         # 目的：让模型分析用户问题，决定是否需要调用工具
         # 输入：用户问题 + 可用工具列表
         # 输出：文本回答 或 函数调用指令
-        print(">>> 第1次调用大模型：让模型决定是否调用工具...")
-        response = self.client.models.generate_content(
-            model=self.model,
-            contents=self.contents,
-            config=config
-        )
+        logger.info(">>> 第1次调用大模型：让模型决定是否调用工具...")
+        response = self._generate()
 
         # 将模型响应添加到对话历史（轮次2）
-        self.contents.append(response.candidates[0].content)
+        self._append(response.candidates[0].content)
 
         # ------------------------------------------------------------------
         # 步骤4：检查模型是否决定调用工具
         # ------------------------------------------------------------------
-        # 检查第一个 part 是否有 function_call
-        has_function_call = (
-            response.candidates[0].content.parts
-            and hasattr(response.candidates[0].content.parts[0], 'function_call')
-            and response.candidates[0].content.parts[0].function_call
-        )
+        function_calls = self._function_calls(response)
 
-        if has_function_call:
-            print(">>> 模型决定调用工具！开始执行...")
-
-            # 提取所有函数调用（可能有多个）
-            function_calls = [
-                part.function_call
-                for part in response.candidates[0].content.parts
-                if part.function_call
-            ]
+        if function_calls:
+            logger.info(">>> 模型决定调用工具！开始执行...")
 
             # ------------------------------------------------------------------
             # 步骤5：执行所有函数调用（在本地执行，不访问大模型！）
             # ------------------------------------------------------------------
-            for function_call in function_calls:
-                function_name = function_call.name  # 工具名称，如 "list_dir"
-                function_args = function_call.args  # 参数，如 {"directory_path": "."}
-
-                print(f">>> 在本地执行工具: {function_name}({function_args})")
-
-                # 检查工具是否存在
-                if function_name in self.tools:
-                    # 调用实际的 Python 函数（本地执行）
-                    # **function_args 将字典展开为关键字参数
-                    # 例如：list_dir(**{"directory_path": "."})
-                    #    等价于：list_dir(directory_path=".")
-                    result = self.tools[function_name]["function"](**function_args)
-
-                    print(f">>> 工具执行结果: {result}")
-
-                    # 将函数执行结果添加到对话历史（轮次3）
-                    self.contents.append({
-                        "role": "user",  # 角色：用户（函数结果以用户身份发送）
-                        "parts": [{
-                            "function_response": {
-                                "name": function_name,
-                                "response": {"result": result}
-                            }
-                        }]
-                    })
+            self._execute_tools(function_calls)
 
             # ------------------------------------------------------------------
             # 步骤6：【第2次调用大模型】
@@ -287,98 +891,556 @@ class Agent:
             # 目的：让模型看到工具执行结果，生成最终的自然语言回答
             # 输入：之前的对话 + 工具执行结果
             # 输出：最终的自然语言回答
-            print(">>> 第2次调用大模型：让模型根据工具结果生成最终回答...")
-            response = self.client.models.generate_content(
+            logger.info(">>> 第2次调用大模型：让模型根据工具结果生成最终回答...")
+            response = self._generate()
+
+            # 将最终回答添加到对话历史（轮次4）
+            self._append(response.candidates[0].content)
+            logger.info(">>> 完成！")
+        else:
+            # 模型没有调用工具，直接返回了文本回答
+            logger.info(">>> 模型没有调用工具，直接返回了文本回答")
+            logger.debug(">>> 回答: %s", response.text if hasattr(response, 'text') else '(无文本)')
+
+        # 把最终回答放入语义缓存。调用过工具的轮次不缓存：回答依赖当时的文件系统，
+        # 而且命中缓存会跳过工具（如 write_file），看起来完成了，实际什么也没做
+        if query_embedding is not None and not function_calls:
+            self._semantic_store(query_embedding, response)
+
+        # 对话历史过长时压缩较早的轮次
+        self._compact()
+
+        return response
+
+    def run_stream(self, contents: str):
+        """
+        流式版本的 run：模型一边生成，一边返回文本片段
+
+        流程与 run 相同（包括工具调用），适合交互式终端，用户不必等整个回答生成完：
+            for text in agent.run_stream("..."):
+                print(text, end="", flush=True)
+
+        注意：流式调用不使用本地响应缓存（response_cache_ttl）
+        """
+        self._refresh_cache()
+
+        # 步骤1：添加用户消息到对话历史（轮次1）
+        self._append(types.Content(role="user", parts=[types.Part.from_text(text=contents)]))
+
+        # 步骤2：查询语义缓存，命中时一次性返回之前的回答
+        query_embedding = None
+        if self.semantic_cache_threshold:
+            query_embedding = self._query_embedding(self._embed(contents))
+            cached = self._semantic_lookup(query_embedding)
+            if cached is not None:
+                self._append(cached.candidates[0].content)
+                self._compact()
+                yield cached.text or ""
+                return
+
+        # 步骤3：【第1次调用大模型】流式输出（轮次2）
+        content = yield from self._stream_generate()
+        self._append(content)
+        response = _response_from_content(content)
+
+        # 步骤4~6：需要调用工具时，执行工具后再流式输出最终回答（轮次3、4）
+        function_calls = self._function_calls(response)
+        if function_calls:
+            self._execute_tools(function_calls)
+            content = yield from self._stream_generate()
+            self._append(content)
+            response = _response_from_content(content)
+
+        if query_embedding is not None and not function_calls:  # 调用过工具的轮次不缓存
+            self._semantic_store(query_embedding, response)
+        self._compact()
+
+    def _prompt_contents(self, prompt: str) -> list:
+        """把一个问题包装成独立的单轮对话"""
+        return [types.Content(role="user", parts=[types.Part.from_text(text=prompt)])]
+
+    def _batch_supported(self) -> bool:
+        """当前 SDK 是否提供批量接口（旧版本没有 batches 和 InlinedRequest）"""
+        return hasattr(self.client, "batches") and hasattr(types, "InlinedRequest")
+
+    def _batch_requests(self, prompts: list[str]) -> list:
+        """把每个问题包装成一个独立的单轮请求"""
+        return [
+            types.InlinedRequest(contents=self._prompt_contents(prompt), config=self._config)
+            for prompt in prompts
+        ]
+
+    def _batch_results(self, job) -> list:
+        """按输入顺序取出批量任务的响应，失败的请求对应 None"""
+        if job.state not in ("JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"):
+            raise RuntimeError(f"批量任务失败: {job.state} {job.error}")
+        return [
+            item.response if item.error is None else None
+            for item in job.dest.inlined_responses
+        ]
+
+    def _generate_each(self, prompts: list[str]) -> list:
+        """没有批量接口时的退路：用线程池并发发送所有请求"""
+        def generate(prompt):
+            return self.client.models.generate_content(
+                model=self.model,
+                contents=self._prompt_contents(prompt),
+                config=self._config
+            )
+
+        with ThreadPoolExecutor(max_workers=min(len(prompts), _MAX_CONCURRENT_REQUESTS)) as executor:
+            return list(executor.map(generate, prompts))
+
+    def run_many(self, prompts: list[str], poll_interval: float = 10):
+        """
+        批量执行多个互不相关的问题（离线评测、批量演示等）
+
+        使用 Gemini 批量接口（Batch API）一次提交所有请求，比逐个调用
+        generate_content 省去每个请求的往返开销，费用也更低；
+        代价是要等整个批量任务完成（可能需要几分钟）。
+
+        参数：
+            prompts: 问题列表，每个问题单独成一轮对话，不写入 self.contents
+            poll_interval: 查询任务状态的间隔（秒）
+
+        返回：
+            与 prompts 顺序一致的响应列表，失败的请求对应 None
+
+        注意：批量请求在服务器端执行，不会执行本地工具。
+        如果响应里有函数调用，需要调用方自行处理。
+        """
+        if not prompts:
+            return []
+        self._refresh_cache()
+        if not self._batch_supported():
+            logger.warning(">>> 当前 SDK 没有批量接口，改为并发请求")
+            return self._generate_each(prompts)
+        try:
+            job = self.client.batches.create(model=self.model, src=self._batch_requests(prompts))
+        except errors.APIError as e:
+            # 当前后端不支持内联批量请求（如 Vertex AI 需要 GCS 输入）
+            logger.warning(">>> 批量接口不可用，改为并发请求: %s", e)
+            return self._generate_each(prompts)
+
+        logger.info(">>> 已提交批量任务: %s", job.name)
+        while job.state not in _BATCH_DONE_STATES:
+            time.sleep(poll_interval)
+            job = self.client.batches.get(name=job.name)
+        return self._batch_results(job)
+
+
+class AsyncAgent(Agent):
+    """
+    异步版本的智能代理
+
+    流程与 Agent 完全相同，区别在于：
+    1. 通过 client.aio 调用大模型，等待网络时不阻塞事件循环
+    2. 工具函数放到线程中执行，open()/os.listdir 等阻塞调用不会卡住事件循环
+
+    这样多个 Agent（或多轮对话）可以并发执行，总耗时约等于最慢的那一个，
+    而不是所有请求耗时之和：
+        await asyncio.gather(agent1.run(q1), agent2.run(q2))
+
+    设置 tool_timeout 后，工具调用变成"先占位、后补结果"：
+    - 超时还没完成的工具先返回 {"status": "pending", "handle": ...} 占位结果，
+      第2次调用大模型不必等它
+    - 工具在后台继续执行，完成后在下一轮用户输入时（轮次边界）把结果补进历史
+    对模型来说协议不变：每个 function_call 仍然对应一个 function_response
+    """
+
+    def __init__(self, *args, tool_timeout: float = None, **kwargs):
+        """
+        初始化异步代理
+
+        参数：
+            tool_timeout: 等待工具执行的最长秒数（可选），默认 None 表示等待全部完成
+            其余参数同 Agent
+        """
+        super().__init__(*args, **kwargs)
+        self.tool_timeout = tool_timeout
+        self._pending_tools = {}  # 后台执行中的工具：{handle: (工具名称, asyncio.Task)}
+        self._next_handle = 0  # 用于生成占位结果的 handle
+
+    async def aclose(self):
+        """
+        异步删除显式缓存（如果有），在事件循环中使用，代替 close()
+
+        调用后不要再使用这个 Agent。
+        """
+        self._cache_pending = False
+        if self._cache is None:
+            return
+        try:
+            await self.client.aio.caches.delete(name=self._cache.name)
+        except errors.APIError as e:
+            logger.warning(">>> 删除缓存失败: %s", e)
+        self._cache = None
+
+    async def _agenerate(self):
+        """异步调用大模型，响应缓存逻辑与 Agent._generate 相同"""
+        if not self.response_cache_ttl:
+            return await self.client.aio.models.generate_content(
                 model=self.model,
                 contents=self.contents,
-                config=config
+                config=self._config
             )
 
-            # 将最终回答添加到对话历史（轮次4）
-            self.contents.append(response.candidates[0].content)
-            print(">>> 完成！")
+        key = self._cache_key()
+        response = self._cache_get(key)
+        if response is not None:
+            logger.info(">>> 命中响应缓存，跳过 API 调用")
+            return response
+        response = await self.client.aio.models.generate_content(
+            model=self.model,
+            contents=self.contents,
+            config=self._config
+        )
+        self._cache_put(key, response)
+        return response
+
+    async def _aembed(self, text: str) -> list[float]:
+        """异步调用向量模型，把用户问题转换成向量"""
+        result = await self.client.aio.models.embed_content(
+            model=_EMBEDDING_MODEL,
+            contents=text,
+            config=types.EmbedContentConfig(
+                task_type="SEMANTIC_SIMILARITY",
+                output_dimensionality=_EMBEDDING_DIM,
+            ),
+        )
+        return result.embeddings[0].values
+
+    async def _acompact(self):
+        """异步检查对话历史长度，必要时压缩"""
+        cut = self._compaction_cut()
+        if cut is None:
+            return
+        try:
+            response = await self.client.aio.models.generate_content(
+                model=_SUMMARY_MODEL,
+                contents=self._summary_request(cut)
+            )
+        except errors.APIError as e:
+            logger.warning(">>> 压缩对话历史失败，跳过: %s", e)
+            return
+        self._apply_summary(cut, response.text)
+
+    def _collect_pending(self) -> list:
+        """
+        轮次边界：收集已经完成的后台工具，转换成文本 part
+
+        还没完成的工具继续留在后台，等下一轮再收集
+        """
+        parts = []
+        for handle, (function_name, task) in list(self._pending_tools.items()):
+            if not task.done():
+                continue
+            del self._pending_tools[handle]
+            result = task.result()
+            logger.info(">>> 后台工具已完成: %s（handle=%s）", function_name, handle)
+            parts.append(types.Part.from_text(
+                text=f"[工具 {function_name} 的异步结果，handle={handle}] "
+                     f"{orjson.dumps(result, option=orjson.OPT_SORT_KEYS, default=str).decode()}"
+            ))
+        return parts
+
+    async def _aexecute_tools(self, function_calls: list):
+        """
+        在线程中并发执行所有函数调用，按调用顺序把结果添加到对话历史（轮次3）
+
+        超过 tool_timeout 还没完成的工具先用占位结果代替
+        """
+        self._log_calls(function_calls)
+        tasks = [
+            asyncio.create_task(asyncio.to_thread(self._run_tool, fc))
+            for fc in function_calls
+        ]
+        done = set()
+        if tasks:
+            done, _ = await asyncio.wait(tasks, timeout=self.tool_timeout)
+
+        for function_call, task in zip(function_calls, tasks):
+            if task in done:
+                result = task.result()
+                logger.debug(">>> 工具执行结果: %r", result)
+            else:
+                # 超时未完成：先返回占位结果，工具在后台继续执行
+                handle = f"{function_call.name}-{self._next_handle}"
+                self._next_handle += 1
+                self._pending_tools[handle] = (function_call.name, task)
+                result = {"status": "pending", "handle": handle}
+                logger.info(">>> 工具仍在后台执行: %s（handle=%s）", function_call.name, handle)
+            self._append(self._function_response(function_call.name, result))  # 轮次3
+
+    async def _astream_generate(self):
+        """
+        异步流式调用大模型：边接收边 yield 文本片段
+
+        异步生成器不能 return 值，所以最后一项 yield 拼好的完整消息（types.Content）
+        """
+        parts = []
+        async for chunk in await self.client.aio.models.generate_content_stream(
+            model=self.model,
+            contents=self.contents,
+            config=self._config
+        ):
+            for part in _chunk_parts(chunk):
+                if part.text and not part.thought:
+                    yield part.text
+                parts.append(part)
+        yield types.Content(role="model", parts=_merge_text_parts(parts))
+
+    async def run(self, contents: str):
+        """
+        异步执行一次完整的对话流程（可能包含工具调用）
+
+        参数和返回值与 Agent.run 相同
+        """
+        # 第一轮时创建显式缓存，之后在快过期时续期（同步接口，放到线程里执行）
+        await asyncio.to_thread(self._refresh_cache)
+
+        # 步骤1：添加用户消息到对话历史（轮次1），
+        # 上一轮还在后台执行的工具如果已经完成，结果随本轮用户消息一起发送
+        self._append(types.Content(
+            role="user",
+            parts=self._collect_pending() + [types.Part.from_text(text=contents)]
+        ))
+
+        # 步骤2：查询语义缓存
+        query_embedding = None
+        if self.semantic_cache_threshold:
+            query_embedding = self._query_embedding(await self._aembed(contents))
+            cached = self._semantic_lookup(query_embedding)
+            if cached is not None:
+                self._append(cached.candidates[0].content)
+                await self._acompact()
+                return cached
+
+        # 步骤3：【第1次调用大模型】
+        logger.info(">>> 第1次调用大模型：让模型决定是否调用工具...")
+        response = await self._agenerate()
+        self._append(response.candidates[0].content)  # 轮次2
+
+        # 步骤4：检查模型是否决定调用工具
+        function_calls = self._function_calls(response)
+
+        if function_calls:
+            logger.info(">>> 模型决定调用工具！开始执行...")
+
+            # 步骤5：在线程中并发执行所有函数调用，结果顺序与调用顺序一致
+            await self._aexecute_tools(function_calls)
+
+            # 步骤6：【第2次调用大模型】
+            logger.info(">>> 第2次调用大模型：让模型根据工具结果生成最终回答...")
+            response = await self._agenerate()
+            self._append(response.candidates[0].content)  # 轮次4
+            logger.info(">>> 完成！")
         else:
-            # 模型没有调用工具，直接返回了文本回答
-            print(">>> 模型没有调用工具，直接返回了文本回答")
-            print(f">>> 回答: {response.text if hasattr(response, 'text') else '(无文本)'}")
+            logger.info(">>> 模型没有调用工具，直接返回了文本回答")
+            logger.debug(">>> 回答: %s", response.text if hasattr(response, 'text') else '(无文本)')
+
+        # 把最终回答放入语义缓存。调用过工具的轮次不缓存：回答依赖当时的文件系统，
+        # 而且命中缓存会跳过工具（如 write_file），看起来完成了，实际什么也没做
+        if query_embedding is not None and not function_calls:
+            self._semantic_store(query_embedding, response)
+
+        await self._acompact()
 
         return response
 
+    async def run_stream(self, contents: str):
+        """
+        异步流式版本的 run，用法：
+            async for text in agent.run_stream("..."):
+                print(text, end="", flush=True)
+        """
+        await asyncio.to_thread(self._refresh_cache)
+
+        # 步骤1：添加用户消息（以及已完成的后台工具结果）到对话历史
+        self._append(types.Content(
+            role="user",
+            parts=self._collect_pending() + [types.Part.from_text(text=contents)]
+        ))
+
+        # 步骤2：查询语义缓存，命中时一次性返回之前的回答
+        query_embedding = None
+        if self.semantic_cache_threshold:
+            query_embedding = self._query_embedding(await self._aembed(contents))
+            cached = self._semantic_lookup(query_embedding)
+            if cached is not None:
+                self._append(cached.candidates[0].content)
+                await self._acompact()
+                yield cached.text or ""
+                return
+
+        # 步骤3：【第1次调用大模型】流式输出（轮次2）
+        async for item in self._astream_generate():
+            if isinstance(item, str):
+                yield item
+            else:
+                content = item
+        self._append(content)
+        response = _response_from_content(content)
+
+        # 步骤4~6：需要调用工具时，执行工具后再流式输出最终回答（轮次3、4）
+        function_calls = self._function_calls(response)
+        if function_calls:
+            await self._aexecute_tools(function_calls)
+            async for item in self._astream_generate():
+                if isinstance(item, str):
+                    yield item
+                else:
+                    content = item
+            self._append(content)
+            response = _response_from_content(content)
+
+        if query_embedding is not None and not function_calls:  # 调用过工具的轮次不缓存
+            self._semantic_store(query_embedding, response)
+        await self._acompact()
+
+    async def _agenerate_each(self, prompts: list[str]) -> list:
+        """没有批量接口时的退路：在当前事件循环中并发发送所有请求"""
+        # 和同步退路一样限制并发数，避免一次发出几百个请求触发 429
+        semaphore = asyncio.Semaphore(_MAX_CONCURRENT_REQUESTS)
+
+        async def generate(prompt):
+            async with semaphore:
+                return await self.client.aio.models.generate_content(
+                    model=self.model,
+                    contents=self._prompt_contents(prompt),
+                    config=self._config
+                )
+
+        return await asyncio.gather(*(generate(prompt) for prompt in prompts))
+
+    async def run_many(self, prompts: list[str], poll_interval: float = 10):
+        """
+        异步批量执行多个互不相关的问题
+
+        参数和返回值与 Agent.run_many 相同，等待批量任务时不阻塞事件循环
+        """
+        if not prompts:
+            return []
+        await asyncio.to_thread(self._refresh_cache)
+        if not self._batch_supported():
+            logger.warning(">>> 当前 SDK 没有批量接口，改为并发请求")
+            return await self._agenerate_each(prompts)
+        try:
+            job = await self.client.aio.batches.create(
+                model=self.model, src=self._batch_requests(prompts)
+            )
+        except errors.APIError as e:
+            logger.warning(">>> 批量接口不可用，改为并发请求: %s", e)
+            return await self._agenerate_each(prompts)
+
+        logger.info(">>> 已提交批量任务: %s", job.name)
+        while job.state not in _BATCH_DONE_STATES:
+            await asyncio.sleep(poll_interval)
+            job = await self.client.aio.batches.get(name=job.name)
+        return self._batch_results(job)
+
 # ==============================================================================
-# 第五部分：主程序 - 创建 Agent 并执行任务
+# 第六部分：显示结果
 # ==============================================================================
 
-# 创建智能代理
-# - 使用 gemini-2.5-flash 模型
-# - 配备 file_tools（文件操作工具）
-# agent = Agent(model="gemini-2.5-flash", tools=file_tools)
-agent = Agent(
-    model="gemini-2.5-flash",
-    tools=file_tools,
-    system_instruction="你是一个有帮助的编码助手。回应时像 Linus Torvalds 一样。"
-)
-print("Agent 已就绪。让它检查此目录中的文件。")
-while True:
-    user_input = input("你: ")
-    if user_input.lower() in ['exit', 'quit']:
-        break
-    response = agent.run(user_input)
-    print(f"Linus: {response.text}\n")
-
-# 执行任务
-# 注意：这里明确要求使用工具是为了演示，实际使用时可以用自然语言提问
-# 例如："这个目录里有哪些文件？" 模型会自动决定调用 list_dir
-response = agent.run(
-    contents="当前目录中有几个包含tools名字的文件"
-    # contents="请使用 list_dir 工具列出 '.' 目录中的文件"
-)
+def show_result(agent: Agent, response):
+    """显示最终回答和完整对话历史"""
+
+    # 显示最终回答
+    print("=" * 60)
+    print("【最终回答】")
+    print(response.text if hasattr(response, 'text') else "无文本内容")
+    print("=" * 60)
+
+    # 显示完整对话历史（4个轮次），历史可能很长，只在 DEBUG 级别输出
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+
+    logger.debug("【完整对话历史】")
+    logger.debug("说明：")
+    logger.debug("  - 轮次 = 对话中的每一条消息")
+    logger.debug("  - 本示例有4个轮次，2次大模型调用，1次本地函数执行")
+
+    for i, content in enumerate(agent.contents):
+        logger.debug("\n轮次 %d:", i + 1)
+
+        logger.debug("  角色: %s", content.role or 'model')
+
+        # 显示每个 part 的内容
+        for part in content.parts or ():
+            if part.text:
+                logger.debug("  文本: %s", part.text)
+            elif part.function_call:
+                logger.debug("  函数调用: %s(%r)", part.function_call.name, part.function_call.args)
+            elif part.function_response:
+                logger.debug(
+                    "  函数响应: %s -> %s",
+                    part.function_response.name,
+                    orjson.dumps(
+                        part.function_response.response,
+                        option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS,
+                        default=str,
+                    ).decode(),
+                )
+
+    logger.debug("=" * 60)
 
 # ==============================================================================
-# 第六部分：显示结果
+# 第七部分：主程序 - 创建 Agent 并执行任务
 # ==============================================================================
 
-# 显示最终回答
-print("=" * 60)
-print("【最终回答】")
-print(response.text if hasattr(response, 'text') else "无文本内容")
-print("=" * 60)
-
-# 显示完整对话历史（4个轮次）
-print("【完整对话历史】")
-print("说明：")
-print("  - 轮次 = 对话中的每一条消息")
-print("  - 本示例有4个轮次，2次大模型调用，1次本地函数执行")
-print()
-
-for i, content in enumerate(agent.contents):
-    print(f"\n轮次 {i+1}:")
-
-    # 处理不同类型的内容（字典或对象）
-    if isinstance(content, dict):
-        # 字典类型（用户消息）
-        print(f"  角色: {content.get('role', 'model')}")
-        parts = content.get('parts', [])
-    else:
-        # 对象类型（模型响应）
-        print(f"  角色: {getattr(content, 'role', 'model')}")
-        parts = getattr(content, 'parts', [])
-
-    # 显示每个 part 的内容
-    for part in parts:
-        if isinstance(part, dict):
-            # 字典类型的 part
-            if 'text' in part:
-                print(f"  文本: {part['text']}")
-            elif 'function_response' in part:
-                print(f"  函数响应: {part['function_response']}")
-        else:
-            # 对象类型的 part
-            if hasattr(part, 'text') and part.text:
-                print(f"  文本: {part.text}")
-            elif hasattr(part, 'function_call') and part.function_call:
-                print(f"  函数调用: {part.function_call.name}({part.function_call.args})")
+async def main():
+    # 只配置本模块的 logger，不动根 logger：否则 httpx 会在每次请求时打印
+    # "HTTP Request: POST ..."，插进流式输出中间；DEBUG 时 httpcore 的日志会刷屏
+    level = os.environ.get("AGENT_LOG_LEVEL", "INFO").upper()
+    invalid_level = not isinstance(logging.getLevelName(level), int)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(logging.INFO if invalid_level else level)
+    if invalid_level:
+        # 拼错的级别名会让 setLevel 抛出 ValueError，这里退回 INFO
+        logger.warning(">>> 无效的 AGENT_LOG_LEVEL=%r，改用 INFO", level)
+
+    # 创建智能代理
+    # - 使用 gemini-2.5-flash 模型
+    # - 配备 file_tools（文件操作工具）
+    # agent = AsyncAgent(model="gemini-2.5-flash", tools=file_tools)
+    agent = AsyncAgent(
+        model="gemini-2.5-flash",
+        tools=file_tools,
+        system_instruction="你是一个有帮助的编码助手。回应时像 Linus Torvalds 一样。"
+    )
+    print("Agent 已就绪。让它检查此目录中的文件。")
+    try:
+        while True:
+            # input() 会阻塞，放到线程里执行，避免卡住事件循环
+            user_input = await asyncio.to_thread(input, "你: ")
+            if user_input.lower() in ['exit', 'quit']:
+                break
+            # 流式输出：模型生成一段就打印一段
+            print("Linus: ", end="", flush=True)
+            async for text in agent.run_stream(user_input):
+                print(text, end="", flush=True)
+            print("\n")
+
+        # 执行任务
+        # 注意：这里明确要求使用工具是为了演示，实际使用时可以用自然语言提问
+        # 例如："这个目录里有哪些文件？" 模型会自动决定调用 list_dir
+        response = await agent.run(
+            contents="当前目录中有几个包含tools名字的文件"
+            # contents="请使用 list_dir 工具列出 '.' 目录中的文件"
+        )
+
+        show_result(agent, response)
+    finally:
+        await agent.aclose()  # 删除显式缓存（如果创建了的话）
 
-print("=" * 60)
+
+if __name__ == "__main__":
+    asyncio.run(main())
 
 # ==============================================================================
 # 运行说明
@@ -392,6 +1454,10 @@ print("=" * 60)
 #
 # 3. 预期输出：
 #    - 最终回答：模型用自然语言列出文件
-#    - 对话历史：显示4个轮次的完整交互过程
+#    - 对话历史：显示4个轮次的完整交互过程（需要 DEBUG 日志级别）
+#
+# 4. 调整日志详细程度（可选）：
+#    AGENT_LOG_LEVEL=DEBUG python3 toolsAgent.py    # 显示工具结果和对话历史
+#    AGENT_LOG_LEVEL=WARNING python3 toolsAgent.py  # 安静模式
 #
 # ==============================================================================
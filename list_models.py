@@ -1,24 +1,30 @@
-from google import genai
 import os
+import sys
 
-# 检查 API key 是否设置
+# 检查 API key 是否设置（在导入 SDK 之前检查，没有设置时立即报错）
 api_key = os.environ.get('GEMINI_API_KEY') or os.environ.get('GOOGLE_API_KEY')
 if not api_key:
     print("错误: 请先设置 GEMINI_API_KEY 或 GOOGLE_API_KEY 环境变量")
     print("例如: export GEMINI_API_KEY='your-api-key'")
     exit(1)
 
+from google import genai
+
 # 列出所有可用的模型
 client = genai.Client(api_key=api_key)
 
-print("可用的 Gemini 模型：\n")
+# 先把所有输出收集起来，最后一次性写出，避免每行一次 write 系统调用
+lines = ["可用的 Gemini 模型：\n"]
 try:
-    for model in client.models.list():
-        print(f"模型名称: {model.name}")
+    # 每页多取一些模型，减少分页请求次数
+    for model in client.models.list(config={"page_size": 100}):
+        lines.append(f"模型名称: {model.name}")
         if hasattr(model, 'supported_generation_methods'):
-            print(f"  支持的方法: {model.supported_generation_methods}")
+            lines.append(f"  支持的方法: {model.supported_generation_methods}")
         if hasattr(model, 'display_name'):
-            print(f"  显示名称: {model.display_name}")
-        print("-" * 60)
+            lines.append(f"  显示名称: {model.display_name}")
+        lines.append("-" * 60)
 except Exception as e:
-    print(f"列出模型时出错: {e}")
+    lines.append(f"列出模型时出错: {e}")
+
+sys.stdout.write("\n".join(lines) + "\n")